@@ -1,11 +1,24 @@
-import jwt
+import base64
+import hashlib
+import hmac
+import logging
+import orjson
+import os
 from typing import Optional, List
 from contextlib import asynccontextmanager
 from enum import Enum
+from functools import lru_cache
+from threading import Lock
 
-from fastapi import FastAPI, HTTPException
+from cachetools import TTLCache
+
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 
+from sqlalchemy import bindparam, event, insert
+from sqlalchemy.orm import sessionmaker
 from sqlmodel import (
     Field,
     Session,
@@ -13,18 +26,50 @@ from sqlmodel import (
     create_engine,
     select,
     delete,
+    func,
     Column,
     JSON,
 )
 
 
 CUBE_API_SECRET = "apisecret"
+CUBE_API_SECRET_BYTES = CUBE_API_SECRET.encode()
+
+SQL_ECHO = os.environ.get("SQL_ECHO") == "1"
+RESET_FIXTURES = os.environ.get("RESET_FIXTURES") == "1"
+FRONTEND_ORIGINS = os.environ.get(
+    "FRONTEND_ORIGINS", "http://localhost:3000"
+).split(",")
 
 sqlite_file_name = "api.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+engine = create_engine(
+    sqlite_url,
+    echo=SQL_ECHO,
+    connect_args=connect_args,
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
+
+
+SessionLocal = sessionmaker(
+    engine, class_=Session, autoflush=False, expire_on_commit=False
+)
 
 
 class Destination(SQLModel, table=True):
@@ -53,69 +98,100 @@ class Tenant(SQLModel, table=True):
         arbitrary_types_allowed = True
 
 
+SELECT_DESTINATIONS = select(Destination)
+COUNT_DESTINATIONS = select(func.count()).select_from(Destination)
+SELECT_TENANTS = select(Tenant)
+SELECT_TENANT_WITH_DESTINATION = (
+    select(Tenant, Destination)
+    .outerjoin(Destination, Tenant.destination_id == Destination.id)
+    .where(Tenant.id == bindparam("tenant_id"))
+)
+
+
 def setup():
     SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        # Delete old destinations
-        statement = delete(Destination)
-        session.exec(statement)
-        statement = delete(Tenant)
-        session.exec(statement)
-        session.commit()
-
-        # Create new destinations
-        destination1 = Destination(
-            type="postgres",
-            hostname="destination1",
-            port=5432,
-            database="database1",
-            schema="public",
-            username="username1",
-            password="password1",
+    with SessionLocal() as session, session.begin():
+        # Keep existing fixtures on warm restarts
+        if not RESET_FIXTURES and session.exec(COUNT_DESTINATIONS).one() > 0:
+            return
+
+        # Replace old destinations and tenants
+        session.exec(delete(Tenant))
+        session.exec(delete(Destination))
+        session.exec(
+            insert(Destination),
+            params=[
+                {
+                    "id": 1,
+                    "type": "postgres",
+                    "hostname": "destination1",
+                    "port": 5432,
+                    "database": "database1",
+                    "schema": "public",
+                    "username": "username1",
+                    "password": "password1",
+                },
+                {
+                    "id": 2,
+                    "type": "postgres",
+                    "hostname": "destination2",
+                    "port": 5432,
+                    "database": "database2",
+                    "schema": "public",
+                    "username": "username2",
+                    "password": "password2",
+                },
+            ],
         )
-
-        destination2 = Destination(
-            type="postgres",
-            hostname="destination2",
-            port=5432,
-            database="database2",
-            schema="public",
-            username="username2",
-            password="password2",
+        session.exec(
+            insert(Tenant),
+            params=[
+                {
+                    "id": 1,
+                    "name": "tenant1",
+                    "data_models": [DataModel.paid_performance.value],
+                    "destination_id": 1,
+                },
+                {
+                    "id": 2,
+                    "name": "tenant2",
+                    "data_models": [
+                        DataModel.paid_performance.value,
+                        DataModel.ecommerce_attribution.value,
+                    ],
+                    "destination_id": 2,
+                },
+            ],
         )
 
-        session.add(destination1)
-        session.add(destination2)
-        session.commit()
 
-        # Create new tenants
-        tenant1 = Tenant(
-            name="tenant1",
-            data_models=[DataModel.paid_performance.value],
-            destination_id=destination1.id,
-        )
-        session.add(tenant1)
+def teardown():
+    pass
 
-        tenant2 = Tenant(
-            name="tenant2",
-            data_models=[
-                DataModel.paid_performance.value,
-                DataModel.ecommerce_attribution.value,
-            ],
-            destination_id=destination2.id,
-        )
-        session.add(tenant2)
-        session.commit()
 
-        session.refresh(tenant1)
-        session.refresh(tenant2)
+def base64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
 
-        print("Tenant 1:", tenant1)
-        print("Tenant 2:", tenant2)
 
+JWT_HEADER_B64 = base64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+JWT_HMAC = hmac.new(CUBE_API_SECRET_BYTES, digestmod=hashlib.sha256)
 
-def teardown():
-    pass
+# Tokens per tenant, so repeated polls skip the database and signing
+token_cache = TTLCache(maxsize=1024, ttl=15)
+token_cache_lock = Lock()
+
+
+@lru_cache(maxsize=1024)
+def sign_token(payload: bytes) -> str:
+    signing_input = JWT_HEADER_B64 + b"." + base64url_encode(payload)
+    signature = JWT_HMAC.copy()
+    signature.update(signing_input)
+    return (signing_input + b"." + base64url_encode(signature.digest())).decode()
+
+
+def get_session():
+    with SessionLocal() as session:
+        yield session
 
 
 @asynccontextmanager
@@ -125,63 +201,69 @@ async def lifespan(app: FastAPI):
     teardown()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=FRONTEND_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 
 @app.get("/destinations/", response_model=List[Destination])
-def list_destinations():
-    with Session(engine) as session:
-        destinations = session.exec(select(Destination)).all()
-        return destinations
+def list_destinations(session: Session = Depends(get_session)):
+    destinations = session.exec(SELECT_DESTINATIONS).all()
+    return ORJSONResponse([destination.model_dump() for destination in destinations])
 
 
 @app.get("/destinations/{destination_id}", response_model=Destination)
-def retrieve_destination(destination_id: int):
-    with Session(engine) as session:
-        destination = session.get(Destination, destination_id)
-        if not destination:
-            raise HTTPException(status_code=404, detail="Destination not found")
-        return destination
+def retrieve_destination(destination_id: int, session: Session = Depends(get_session)):
+    destination = session.get(Destination, destination_id)
+    if not destination:
+        raise HTTPException(status_code=404, detail="Destination not found")
+    return destination
 
 
 @app.get("/tenants/", response_model=List[Tenant])
-def list_tenants():
-    with Session(engine) as session:
-        tenants = session.exec(select(Tenant)).all()
-        return tenants
+def list_tenants(session: Session = Depends(get_session)):
+    tenants = session.exec(SELECT_TENANTS).all()
+    return ORJSONResponse([tenant.model_dump() for tenant in tenants])
 
 
 @app.get("/tenants/{tenant_id}", response_model=Tenant)
-def retrieve_tenant(tenant_id: int):
-    with Session(engine) as session:
-        tenant = session.get(Tenant, tenant_id)
-        if not tenant:
-            raise HTTPException(status_code=404, detail="Tenant not found")
-        return tenant
+def retrieve_tenant(tenant_id: int, session: Session = Depends(get_session)):
+    tenant = session.get(Tenant, tenant_id)
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Tenant not found")
+    return tenant
 
 
 @app.get("/tenants/{tenant_id}/token")
-def generate_jwt_token(tenant_id: int) -> str:
-    with Session(engine) as session:
-        tenant = session.get(Tenant, tenant_id)
-        if not tenant:
-            raise HTTPException(status_code=404, detail="Tenant not found")
-        destination = session.get(Destination, tenant.destination_id)
-        if not destination:
-            raise HTTPException(status_code=404, detail="Destination not found")
-        token_payload = {
-            "tenant_id": tenant.id,
-            "tenant_name": tenant.name,
-            "data_models": tenant.data_models,
-            "destination": destination.model_dump(),
-        }
-        token = jwt.encode(token_payload, CUBE_API_SECRET, algorithm="HS256")
+def generate_jwt_token(tenant_id: int, session: Session = Depends(get_session)) -> str:
+    with token_cache_lock:
+        token = token_cache.get(tenant_id)
+    if token is not None:
         return token
+
+    row = session.exec(
+        SELECT_TENANT_WITH_DESTINATION, params={"tenant_id": tenant_id}
+    ).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Tenant not found")
+    tenant, destination = row
+    if not destination:
+        raise HTTPException(status_code=404, detail="Destination not found")
+    token_payload = {
+        "tenant_id": tenant.id,
+        "tenant_name": tenant.name,
+        "data_models": tenant.data_models,
+        "destination": destination.model_dump(),
+    }
+    token = sign_token(orjson.dumps(token_payload))
+    with token_cache_lock:
+        token_cache[tenant_id] = token
+    return token